@@ -1,7 +1,15 @@
+import math
 import torch
+import warnings
 import itertools
 from argparse import ArgumentParser
+from contextlib import contextmanager
+from torch.func import functional_call, grad, vmap
+from torch.nn.utils import parameters_to_vector
+from torch.utils.checkpoint import checkpoint, checkpoint_sequential
+from torch.utils.data import RandomSampler
 
+from utils import CUDAPrefetcher
 from datasets.exemplars_dataset import ExemplarsDataset
 from .incremental_learning import Inc_Learning_Appr
 
@@ -14,7 +22,8 @@ class Appr(Inc_Learning_Appr):
     def __init__(self, model, device, nepochs=100, lr=0.05, lr_min=1e-4, lr_factor=3, lr_patience=5, clipgrad=10000,
                  momentum=0, wd=0, multi_softmax=False, wu_nepochs=0, wu_lr_factor=1, fix_bn=False, eval_on_train=False,
                  logger=None, exemplars_dataset=None, lamb=5000, alpha=0.5, fi_sampling_type='max_pred',
-                 fi_num_samples=-1):
+                 fi_num_samples=-1, fi_batch_size=-1, fi_chunk_size=8, fi_batch_grad=False,
+                 fi_checkpoint=False, compile_penalty=False):
         super(Appr, self).__init__(model, device, nepochs, lr, lr_min, lr_factor, lr_patience, clipgrad, momentum, wd,
                                    multi_softmax, wu_nepochs, wu_lr_factor, fix_bn, eval_on_train, logger,
                                    exemplars_dataset)
@@ -22,14 +31,30 @@ class Appr(Inc_Learning_Appr):
         self.alpha = alpha
         self.sampling_type = fi_sampling_type
         self.num_samples = fi_num_samples
+        self.fi_batch_size = fi_batch_size
+        self.fi_chunk_size = fi_chunk_size
+        self.per_sample = not fi_batch_grad
+        self.checkpoint_blocks = fi_checkpoint
+        if self.checkpoint_blocks and self.per_sample:
+            warnings.warn("Warning: --fi-checkpoint only applies to --fi-batch-grad, the per-sample Fisher information "
+                          "does not keep activations for a batch backward.")
+        # fuse the penalty into a single kernel with inductor
+        self._penalty = torch.compile(ewc_penalty, fullgraph=True) if compile_penalty else ewc_penalty
 
         # In all cases, we only keep importance weights for the model, but not for the heads.
         feat_ext = self.model.model
+        # Keep the offset and shape of each parameter inside the flat buffers
+        self._offsets, offset = {}, 0
+        for n, p in feat_ext.named_parameters():
+            if p.requires_grad:
+                self._offsets[n] = (offset, p.shape)
+                offset += p.numel()
         # Store current parameters as the initial parameters before first task starts
-        self.older_params = {n: p.clone().detach() for n, p in feat_ext.named_parameters() if p.requires_grad}
-        # Store fisher information weight importance
-        self.fisher = {n: torch.zeros(p.shape).to(self.device) for n, p in feat_ext.named_parameters()
-                       if p.requires_grad}
+        self._older_flat = parameters_to_vector(p.detach() for n, p in feat_ext.named_parameters()
+                                                if n in self._offsets).to(self.device)
+        # Store fisher information weight importance -- only used as fixed weights, so bfloat16 is enough
+        self._fisher_flat = torch.zeros(offset, dtype=torch.bfloat16, device=self.device)
+        self._update_penalty_buffers()
 
     @staticmethod
     def exemplars_dataset_class():
@@ -50,9 +75,61 @@ class Appr(Inc_Learning_Appr):
                             help='Sampling type for Fisher information (default=%(default)s)')
         parser.add_argument('--fi-num-samples', default=-1, type=int, required=False,
                             help='Number of samples for Fisher information (-1: all available) (default=%(default)s)')
+        parser.add_argument('--fi-batch-size', default=-1, type=int, required=False,
+                            help='Batch size for Fisher information (-1: same as training) (default=%(default)s)')
+        # Per-sample gradients take one copy of the parameters per sample, so they are computed in small chunks
+        parser.add_argument('--fi-chunk-size', default=8, type=int, required=False,
+                            help='Number of samples whose gradients are computed at once for the per-sample Fisher '
+                                 'information (default=%(default)s)')
+        # By default the gradients of each sample are squared (empirical Fisher diagonal), with the model in eval mode
+        # (no dropout, batch normalization running statistics). Squaring the gradient of the batch in train mode
+        # instead is cheaper but only approximates it, kept for comparison with previous results
+        parser.add_argument('--fi-batch-grad', action='store_true', required=False,
+                            help='Square batch gradients in train mode instead of per-sample gradients in eval mode '
+                                 'for Fisher information, which is not the empirical Fisher diagonal '
+                                 '(default=%(default)s)')
+        parser.add_argument('--fi-checkpoint', action='store_true', required=False,
+                            help='Recompute transformer block activations when computing Fisher information with '
+                                 '--fi-batch-grad, to fit a larger --fi-batch-size (default=%(default)s)')
+        parser.add_argument('--compile-penalty', action='store_true', required=False,
+                            help='Compile the quadratic penalty with torch.compile (default=%(default)s)')
 
         return parser.parse_known_args(args)
 
+    @property
+    def older_params(self):
+        """Parameters stored after the previous task, as views into the flat buffer"""
+        return self._unpack(self._older_flat)
+
+    @property
+    def fisher(self):
+        """Fisher information weight importance, as views into the flat buffer"""
+        return self._unpack(self._fisher_flat)
+
+    def _unpack(self, flat):
+        """Returns a dict with a view into the flat buffer for each parameter"""
+        return {n: flat[o:o + shape.numel()].view(shape) for n, (o, shape) in self._offsets.items()}
+
+    def _update_penalty_buffers(self):
+        """Gathers the fisher and old parameters used by the penalty, skipping tensors with a numerically zero
+        fisher since they do not contribute to it
+        """
+        fisher = self.fisher
+        self._active_mask = {n: bool(f.abs().max() > 1e-12) for n, f in fisher.items()}
+        active = [n for n, is_active in self._active_mask.items() if is_active]
+        # select the parameters by position, in the same order as the penalty buffers, to avoid looking them up by
+        # name at every step -- references are not kept since the model can be replaced (e.g. GridSearch copies)
+        self._penalty_mask = [self._active_mask.get(n, False) for n, _ in self.model.model.named_parameters()]
+        if len(active) == len(fisher):
+            # nothing to skip -- use the flat buffers directly
+            self._penalty_fisher, self._penalty_older = self._fisher_flat, self._older_flat
+        elif len(active) > 0:
+            older_params = self.older_params
+            self._penalty_fisher = parameters_to_vector(fisher[n] for n in active)
+            self._penalty_older = parameters_to_vector(older_params[n] for n in active)
+        else:
+            self._penalty_fisher, self._penalty_older = None, None
+
     def _get_optimizer(self):
         """Returns the optimizer"""
         if len(self.exemplars_dataset) == 0 and len(self.model.heads) > 1:
@@ -64,49 +141,97 @@ class Appr(Inc_Learning_Appr):
 
     def compute_fisher_matrix_diag(self, trn_loader):
         # Store Fisher Information
-        fisher = {n: torch.zeros(p.shape).to(self.device) for n, p in self.model.model.named_parameters()
-                  if p.requires_grad}
+        fisher = {n: torch.zeros_like(p) for n, p in self.model.model.named_parameters() if p.requires_grad}
+        # Use a different batch size than training, keeping the rest of the loader settings
+        if self.fi_batch_size > 0 and self.fi_batch_size != trn_loader.batch_size:
+            trn_loader = torch.utils.data.DataLoader(trn_loader.dataset,
+                                                     batch_size=self.fi_batch_size,
+                                                     shuffle=isinstance(trn_loader.sampler, RandomSampler),
+                                                     num_workers=trn_loader.num_workers,
+                                                     collate_fn=trn_loader.collate_fn,
+                                                     pin_memory=trn_loader.pin_memory,
+                                                     drop_last=trn_loader.drop_last)
         # Compute fisher information for specified number of samples -- rounded to the batch size
         n_samples_batches = (self.num_samples // trn_loader.batch_size + 1) if self.num_samples > 0 \
             else (len(trn_loader.dataset) // trn_loader.batch_size)
         # Do forward and backward pass to compute the fisher information
-        self.model.train()
-        for images, targets in itertools.islice(trn_loader, n_samples_batches):
-            outputs = self.model.forward(images.to(self.device))
+        # per-sample statistics are not defined for batch normalization, so use eval mode in that case -- this also
+        # disables dropout, unlike the batch gradient path
+        self.model.train(not self.per_sample)
+        # forward and backward in bfloat16 when the GPU supports it, in both the batch and the per-sample path --
+        # squared gradients and fisher are still accumulated in float32
+        use_bf16 = torch.device(self.device).type == 'cuda' and torch.cuda.is_bf16_supported()
+        # the per-sample path only needs the outputs of the batch forward to sample the labels
+        needs_outputs = not self.per_sample or self.sampling_type != 'true'
+        # batches are copied to the device ahead of time, while the previous one is being processed
+        for images, targets in itertools.islice(CUDAPrefetcher(trn_loader, self.device), n_samples_batches):
+            if needs_outputs:
+                with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=use_bf16), \
+                        torch.set_grad_enabled(not self.per_sample), \
+                        checkpointed_blocks(self.model.model, enabled=self.checkpoint_blocks):
+                    outputs = self.model.forward(images)
 
             if self.sampling_type == 'true':
                 # Use the labels to compute the gradients based on the CE-loss with the ground truth
-                preds = targets.to(self.device)
+                preds = targets
             elif self.sampling_type == 'max_pred':
                 # Not use labels and compute the gradients related to the prediction the model has learned
-                preds = torch.cat(outputs, dim=1).argmax(1).flatten()
+                # heads may be bfloat16 under autocast, pick the label from the float32 logits
+                preds = multi_head_argmax([out.float() for out in outputs])
             elif self.sampling_type == 'multinomial':
                 # Use a multinomial sampling to compute the gradients
-                probs = torch.nn.functional.softmax(torch.cat(outputs, dim=1), dim=1)
-                preds = torch.multinomial(probs, len(targets)).flatten()
+                # draw one class per sample
+                probs = torch.nn.functional.softmax(torch.cat(outputs, dim=1).detach(), dim=1, dtype=torch.float32)
+                preds = torch.multinomial(probs, num_samples=1).squeeze(1)
 
-            loss = torch.nn.functional.cross_entropy(torch.cat(outputs, dim=1), preds)
-            self.optimizer.zero_grad()
+            if self.per_sample:
+                # Accumulate the squared gradients of each sample, computed in vectorized chunks
+                self._add_per_sample_sq_grads(fisher, images, preds, use_bf16)
+                continue
+            loss = MultiHeadCrossEntropy.apply(preds, *outputs)
+            # gradients are overwritten by backward, so drop them instead of filling them with zeros
+            self.optimizer.zero_grad(set_to_none=True)
             loss.backward()
-            # Accumulate all gradients from loss with regularization
+            # Accumulate all gradients from loss with regularization -- parameters not reached keep a None gradient
             for n, p in self.model.model.named_parameters():
                 if p.grad is not None:
-                    fisher[n] += p.grad.pow(2) * len(targets)
+                    fisher[n].addcmul_(p.grad, p.grad, value=float(len(targets)))
         # Apply mean across all samples
         n_samples = n_samples_batches * trn_loader.batch_size
         fisher = {n: (p / n_samples) for n, p in fisher.items()}
         return fisher
 
+    def _add_per_sample_sq_grads(self, fisher, images, preds, use_bf16=False):
+        """Adds the squared per-sample gradients of the feature extractor to fisher, fi_chunk_size samples at a time"""
+        params = {'model.' + n: p.detach() for n, p in self.model.model.named_parameters() if p.requires_grad}
+        buffers = {n: b.detach() for n, b in self.model.named_buffers()}
+
+        def loss_fn(params, buffers, x, y):
+            outputs = functional_call(self.model, (params, buffers), (x.unsqueeze(0),))
+            return torch.nn.functional.cross_entropy(torch.cat(outputs, dim=1), y.unsqueeze(0))
+
+        per_sample_grad_fn = vmap(grad(loss_fn), in_dims=(None, None, 0, 0))
+        # only keep the gradients of one chunk alive, a [batch, params] tensor does not fit for large models
+        for x, y in zip(images.split(self.fi_chunk_size), preds.split(self.fi_chunk_size)):
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=use_bf16):
+                per_sample_grads = per_sample_grad_fn(params, buffers, x, y)
+            for n, g in per_sample_grads.items():
+                fisher[n[len('model.'):]].add_(g.float().pow(2).sum(0))
+
     def train_loop(self, t, trn_loader, val_loader):
         """Contains the epochs loop"""
 
         # add exemplars to train_loader
         if len(self.exemplars_dataset) > 0 and t > 0:
-            trn_loader = torch.utils.data.DataLoader(trn_loader.dataset + self.exemplars_dataset,
+            # keep the workers alive across epochs instead of restarting them at every epoch
+            workers_kwargs = dict(persistent_workers=True, prefetch_factor=4) if trn_loader.num_workers > 0 else {}
+            trn_loader = torch.utils.data.DataLoader(torch.utils.data.ConcatDataset([trn_loader.dataset,
+                                                                                     self.exemplars_dataset]),
                                                      batch_size=trn_loader.batch_size,
                                                      shuffle=True,
                                                      num_workers=trn_loader.num_workers,
-                                                     pin_memory=trn_loader.pin_memory)
+                                                     pin_memory=trn_loader.pin_memory,
+                                                     **workers_kwargs)
 
         # FINETUNING TRAINING -- contains the epochs loop
         super().train_loop(t, trn_loader, val_loader)
@@ -118,30 +243,132 @@ class Appr(Inc_Learning_Appr):
         """Runs after training all the epochs of the task (after the train session)"""
 
         # Store current parameters for the next task
-        self.older_params = {n: p.clone().detach() for n, p in self.model.model.named_parameters() if p.requires_grad}
+        self._older_flat = parameters_to_vector(p.detach() for n, p in self.model.model.named_parameters()
+                                                if n in self._offsets)
 
         # calculate Fisher information
         curr_fisher = self.compute_fisher_matrix_diag(trn_loader)
+        # Added option to accumulate fisher over time with a pre-fixed growing alpha
+        alpha = self.alpha
+        if self.alpha == -1:
+            # task_cls is a CPU tensor, so this is a host-side scalar computed once for all parameters
+            alpha = self.model.task_cls[:t].sum().item() / self.model.task_cls.sum().item()
         # merge fisher information, we do not want to keep fisher information for each task in memory
-        for n in self.fisher.keys():
-            # Added option to accumulate fisher over time with a pre-fixed growing alpha
-            if self.alpha == -1:
-                alpha = (sum(self.model.task_cls[:t]) / sum(self.model.task_cls)).to(self.device)
-                self.fisher[n] = alpha * self.fisher[n] + (1 - alpha) * curr_fisher[n]
-            else:
-                self.fisher[n] = (self.alpha * self.fisher[n] + (1 - self.alpha) * curr_fisher[n])
+        # lerp computes alpha * old + (1 - alpha) * new in place for all tensors at once, in float32
+        fisher = [f.float() for f in self.fisher.values()]
+        torch._foreach_lerp_(fisher, [curr_fisher[n] for n in self._offsets.keys()], 1 - alpha)
+        self._fisher_flat.copy_(parameters_to_vector(fisher))
+        self._update_penalty_buffers()
 
     def criterion(self, t, outputs, targets):
         """Returns the loss value"""
         loss = 0
-        if t > 0:
-            loss_reg = 0
-            # Eq. 3: elastic weight consolidation quadratic penalty
-            for n, p in self.model.model.named_parameters():
-                if n in self.fisher.keys():
-                    loss_reg += torch.sum(self.fisher[n] * (p - self.older_params[n]).pow(2)) / 2
+        if t > 0 and self._penalty_fisher is not None:
+            params = tuple(itertools.compress(self.model.model.parameters(), self._penalty_mask))
+            loss_reg = self._penalty(params, self._penalty_fisher, self._penalty_older)
             loss += self.lamb * loss_reg
         # Current cross-entropy loss -- with exemplars use all heads
         if len(self.exemplars_dataset) > 0:
             return loss + torch.nn.functional.cross_entropy(torch.cat(outputs, dim=1), targets)
         return loss + torch.nn.functional.cross_entropy(outputs[t], targets - self.model.task_offset[t])
+
+
+@contextmanager
+def checkpointed_blocks(model, enabled=True, blocks_per_segment=2):
+    """Runs the transformer blocks of the model with activation checkpointing, so only the inputs of each segment are
+    kept and the remaining activations are recomputed during the backward pass. Blocks are either `blocks` sequential
+    modules or `layers` lists of residual (attention, feed-forward) pairs as in the early convolution ViT
+    """
+    patched = []
+    for name, m in (model.named_modules() if enabled else []):
+        if name.split('.')[-1] == 'blocks' and isinstance(m, torch.nn.Sequential):
+            segments = math.ceil(len(m) / blocks_per_segment)
+            m.forward = lambda x, blocks=m, segments=segments: checkpoint_sequential(blocks, segments, x,
+                                                                                     use_reentrant=False)
+            patched.append(m)
+        elif isinstance(getattr(m, 'layers', None), torch.nn.ModuleList) and len(m.layers) > 0 and \
+                all(isinstance(layer, torch.nn.ModuleList) and len(layer) == 2 for layer in m.layers):
+            m.forward = lambda x, layers=m.layers: checkpoint_residual_pairs(layers, x)
+            patched.append(m)
+    if enabled and not patched:
+        warnings.warn("Warning: no transformer blocks found in the model, activations are not checkpointed.")
+    try:
+        yield
+    finally:
+        # remove the instance attribute to go back to the class forward
+        for m in patched:
+            del m.forward
+
+
+def checkpoint_residual_pairs(layers, x):
+    """Same as the forward of the early convolution ViT transformer, checkpointing each (attention, feed-forward) pair"""
+    for attn, ff in layers:
+        x = checkpoint(residual_pair, attn, ff, x, use_reentrant=False)
+    return x
+
+
+def residual_pair(attn, ff, x):
+    x = attn(x) + x
+    return ff(x) + x
+
+
+def ewc_penalty(params, fisher, older):
+    """Eq. 3: elastic weight consolidation quadratic penalty, over the flattened parameters"""
+    # the bfloat16 fisher is promoted to the parameter dtype inside the elementwise kernel
+    return torch.sum(fisher * (torch.cat([p.reshape(-1) for p in params]) - older).square()) / 2
+
+
+def multi_head_argmax(outputs):
+    """Returns the argmax over the concatenation of the head outputs, without concatenating them"""
+    best, preds, offset = None, None, 0
+    for out in outputs:
+        val, idx = out.max(1)
+        if best is None:
+            best, preds = val, idx
+        else:
+            # strict comparison keeps the first maximum, as argmax does
+            better = val > best
+            best = torch.where(better, val, best)
+            preds = torch.where(better, idx + offset, preds)
+        offset += out.shape[1]
+    return preds
+
+
+class MultiHeadCrossEntropy(torch.autograd.Function):
+    """Cross-entropy over the concatenation of the head outputs, without materializing the concatenated logits.
+    The log-sum-exp is accumulated head by head, and the softmax is recomputed head by head in the backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, targets, *outputs):
+        lse, target_logit, offset = None, 0, 0
+        idxs, in_heads = [], []
+        for out in outputs:
+            # heads may come from an autocast region, the loss is always computed in float32
+            out = out.float()
+            # online log-sum-exp across heads
+            head_lse = torch.logsumexp(out, dim=1)
+            lse = head_lse if lse is None else torch.logaddexp(lse, head_lse)
+            # pick the target logit from the head that contains the target class -- masked instead of indexed by
+            # the rows of the head, so that the host never waits for the device
+            in_head = (targets >= offset) & (targets < offset + out.shape[1])
+            idx = (targets - offset).clamp(0, out.shape[1] - 1).unsqueeze(1)
+            target_logit = target_logit + out.gather(1, idx).squeeze(1) * in_head
+            idxs.append(idx)
+            in_heads.append(in_head)
+            offset += out.shape[1]
+        # keep the target positions for the backward pass instead of recomputing them
+        ctx.save_for_backward(lse, torch.stack(idxs), torch.stack(in_heads), *outputs)
+        return (lse - target_logit).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        lse, idxs, in_heads, *outputs = ctx.saved_tensors
+        scale = grad_output / lse.shape[0]
+        grads = []
+        for out, idx, in_head in zip(outputs, idxs, in_heads):
+            # d(CE)/d(logits) = softmax - one_hot(targets)
+            head_grad = (out.float() - lse.unsqueeze(1)).exp_()
+            head_grad.scatter_add_(1, idx, -in_head.unsqueeze(1).to(head_grad.dtype))
+            grads.append(head_grad.mul_(scale))
+        return (None, *grads)
@@ -3,6 +3,7 @@ import torch
 import numpy as np
 from argparse import ArgumentParser
 
+from utils import CUDAPrefetcher
 from loggers.exp_logger import ExperimentLogger
 from datasets.exemplars_dataset import ExemplarsDataset
 from torch.optim.lr_scheduler import CosineAnnealingLR
@@ -257,10 +258,10 @@ class Inc_Learning_Appr:
         self.model.train()
         if self.fix_bn and t > 0:
             self.model.freeze_bn()
-        for images, targets in trn_loader:
+        for images, targets in CUDAPrefetcher(trn_loader, self.device):
             # Forward current model
-            outputs = self.model(images.to(self.device))
-            loss = self.criterion(t, outputs, targets.to(self.device))
+            outputs = self.model(images)
+            loss = self.criterion(t, outputs, targets)
             # Backward
             self.optimizer.zero_grad()
             loss.backward()
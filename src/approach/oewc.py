@@ -141,12 +141,16 @@ class Appr(Inc_Learning_Appr):
                 self.fisher[n] = (self.alpha * self.fisher[n] + (1 - self.alpha) * curr_fisher[n])
 
     def compute_orth_loss(self, old_attention_list, attention_list):
-        totloss = 0.
-        for i in range(len(attention_list)):
-            al = attention_list[i].view(-1, 197,197).to(self.device)
-            ol = old_attention_list[i].view(-1, 197,197).to(self.device)
-            totloss += (torch.linalg.matrix_norm((al-ol)+1e-08)*float(i)).mean()
-        return totloss
+        if not attention_list:
+            return 0.
+        # attention maps are recorded on the model device -- stack them as (layers, B * heads, 197, 197)
+        diff = torch.stack([al.view(-1, 197, 197) - ol.view(-1, 197, 197)
+                            for al, ol in zip(attention_list, old_attention_list)])
+        # Frobenius norm of each map, clamped to keep the gradient finite when both maps are equal
+        fro = diff.square().sum(dim=(-1, -2)).clamp_min(1e-16).sqrt()
+        # deeper layers are weighted by their index
+        weights = torch.arange(len(attention_list), device=diff.device, dtype=diff.dtype).view(-1, 1)
+        return (fro * weights).mean(dim=1).sum()
 
     def criterion(self, t, outputs, targets):
         """Returns the loss value"""
@@ -1,4 +1,10 @@
+import torch
+import pytest
+
 from tests import run_main_and_assert
+from approach.ewc import Appr, MultiHeadCrossEntropy, checkpointed_blocks, multi_head_argmax
+from datasets.exemplars_dataset import ExemplarsDataset
+from networks.network import LLL_Net
 
 FAST_LOCAL_TEST_ARGS = "--exp-name local_test --datasets mnist" \
                        " --network LeNet --num-tasks 3 --seed 1 --batch-size 32" \
@@ -23,3 +29,170 @@ def test_ewc_with_warmup():
     args_line += " --warmup-lr-factor 0.5"
     args_line += " --num-exemplars 200"
     run_main_and_assert(args_line)
+
+
+def test_ewc_with_batch_grad_fisher():
+    args_line = FAST_LOCAL_TEST_ARGS
+    args_line += " --fi-batch-grad"
+    run_main_and_assert(args_line)
+
+
+def test_ewc_with_fisher_batch_size():
+    args_line = FAST_LOCAL_TEST_ARGS
+    args_line += " --fi-batch-grad"
+    args_line += " --fi-batch-size 64"
+    run_main_and_assert(args_line)
+
+
+def test_ewc_with_fisher_chunk_size():
+    args_line = FAST_LOCAL_TEST_ARGS
+    args_line += " --fi-chunk-size 3"
+    run_main_and_assert(args_line)
+
+
+def test_ewc_with_multinomial_sampling():
+    args_line = FAST_LOCAL_TEST_ARGS
+    args_line += " --fi-sampling-type multinomial"
+    run_main_and_assert(args_line)
+
+
+def test_ewc_with_growing_alpha():
+    args_line = FAST_LOCAL_TEST_ARGS
+    args_line += " --alpha -1"
+    run_main_and_assert(args_line)
+
+
+def test_multi_head_cross_entropy_matches_cat():
+    torch.manual_seed(1)
+    # 3 heads of different widths (classes 0-2, 3-7, 8-9) with targets in every head
+    outputs = [torch.randn(12, num_cls, requires_grad=True) for num_cls in (3, 5, 2)]
+    targets = torch.tensor([0, 1, 2, 0, 3, 4, 5, 7, 8, 9, 9, 8])
+    loss = MultiHeadCrossEntropy.apply(targets, *outputs)
+    grads = torch.autograd.grad(loss, outputs)
+
+    ref_outputs = [out.detach().clone().requires_grad_() for out in outputs]
+    ref_loss = torch.nn.functional.cross_entropy(torch.cat(ref_outputs, 1), targets)
+    ref_grads = torch.autograd.grad(ref_loss, ref_outputs)
+
+    assert torch.allclose(loss, ref_loss)
+    for head_grad, ref_head_grad in zip(grads, ref_grads):
+        assert head_grad.shape == ref_head_grad.shape
+        assert torch.allclose(head_grad, ref_head_grad, atol=1e-6)
+
+
+def test_multi_head_argmax_matches_cat():
+    torch.manual_seed(1)
+    outputs = [torch.randn(12, num_cls) for num_cls in (3, 5, 2)]
+    # ties across heads keep the first maximum
+    outputs[0][0, 1] = outputs[2][0, 0] = 10.
+    outputs[1][1, 4] = outputs[2][1, 1] = 10.
+    assert torch.equal(multi_head_argmax(outputs), torch.cat(outputs, 1).argmax(1))
+
+
+class SequentialBlocksNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.blocks = torch.nn.Sequential(*[torch.nn.Sequential(torch.nn.Linear(8, 8), torch.nn.GELU())
+                                            for _ in range(5)])
+        self.fc = torch.nn.Linear(8, 3)
+
+    def forward(self, x):
+        return self.fc(self.blocks(x))
+
+
+class ResidualLayers(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([torch.nn.ModuleList([torch.nn.Linear(8, 8), torch.nn.Linear(8, 8)])
+                                           for _ in range(3)])
+
+    def forward(self, x):
+        for attn, ff in self.layers:
+            x = attn(x) + x
+            x = ff(x) + x
+        return x
+
+
+class ResidualLayersNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.transformer = ResidualLayers()
+        self.fc = torch.nn.Linear(8, 3)
+
+    def forward(self, x):
+        return self.fc(self.transformer(x))
+
+
+@pytest.mark.parametrize('net_class, patched_name', [(SequentialBlocksNet, 'blocks'),
+                                                     (ResidualLayersNet, 'transformer')])
+def test_checkpointed_blocks_matches_plain_forward(net_class, patched_name):
+    torch.manual_seed(1)
+    net = net_class()
+    x = torch.randn(4, 8)
+    ref_grads = torch.autograd.grad(net(x).square().sum(), list(net.parameters()))
+    with checkpointed_blocks(net):
+        assert 'forward' in getattr(net, patched_name).__dict__
+        grads = torch.autograd.grad(net(x).square().sum(), list(net.parameters()))
+    for grad, ref_grad in zip(grads, ref_grads):
+        assert torch.allclose(grad, ref_grad, atol=1e-6)
+    # the class forward is restored on exit
+    assert 'forward' not in getattr(net, patched_name).__dict__
+
+
+def test_checkpointed_blocks_warns_without_blocks():
+    net = torch.nn.Sequential(torch.nn.Linear(8, 3))
+    with pytest.warns(UserWarning):
+        with checkpointed_blocks(net):
+            net(torch.randn(4, 8))
+
+
+class TinyNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.fc1 = torch.nn.Linear(6, 8)
+        self.fc2 = torch.nn.Linear(8, 8)
+        self.fc3 = torch.nn.Linear(8, 8)
+        self.fc = torch.nn.Linear(8, 4)
+        self.head_var = 'fc'
+
+    def forward(self, x):
+        return self.fc(torch.relu(self.fc3(torch.relu(self.fc2(torch.relu(self.fc1(x)))))))
+
+
+@pytest.mark.parametrize('compile_penalty', [False, True])
+@pytest.mark.parametrize('zeroed', [(), ('fc1.bias', 'fc3.weight'), ('fc1.weight', 'fc2.weight', 'fc3.weight')])
+def test_ewc_penalty_matches_dict_loop(zeroed, compile_penalty):
+    torch.manual_seed(1)
+    net = LLL_Net(TinyNet(), remove_existing_head=True)
+    net.add_head(3)
+    net.add_head(2)
+    # frozen parameters have no fisher and must be skipped by the penalty
+    net.model.fc2.bias.requires_grad_(False)
+    appr = Appr(net, 'cpu', lamb=3, compile_penalty=compile_penalty,
+                exemplars_dataset=ExemplarsDataset(transform=None, class_indices=[]))
+    # a fisher with some zero tensors, and parameters that moved away from the old ones
+    appr._fisher_flat.copy_(torch.rand_like(appr._fisher_flat, dtype=torch.float32))
+    fisher = appr.fisher
+    for n in zeroed:
+        fisher[n].zero_()
+    appr._update_penalty_buffers()
+    with torch.no_grad():
+        for p in net.model.parameters():
+            p.add_(torch.randn_like(p))
+
+    outputs = [torch.randn(5, 3), torch.randn(5, 2)]
+    targets = torch.tensor([3, 4, 4, 3, 3])
+    params = [p for p in net.model.parameters() if p.requires_grad]
+    loss = appr.criterion(1, outputs, targets)
+    grads = torch.autograd.grad(loss, params, allow_unused=True)
+
+    named_params = dict(net.model.named_parameters())
+    older_params = appr.older_params
+    ref_loss = sum(torch.sum(fisher[n].float() * (named_params[n] - older_params[n]) ** 2) / 2 for n in fisher)
+    ref_loss = appr.lamb * ref_loss + torch.nn.functional.cross_entropy(outputs[1], targets - net.task_offset[1])
+    ref_grads = torch.autograd.grad(ref_loss, params)
+
+    assert torch.allclose(loss, ref_loss)
+    for grad, ref_grad in zip(grads, ref_grads):
+        # parameters with a zero fisher are not reached by the penalty
+        assert torch.allclose(torch.zeros_like(ref_grad) if grad is None else grad, ref_grad, atol=1e-6)
@@ -16,6 +16,47 @@ def seed_everything(seed=0):
     torch.backends.cudnn.deterministic = cudnn_deterministic
 
 
+class CUDAPrefetcher:
+    """Iterates over a data loader copying the next batch to the GPU on a side stream while the current one is used.
+    On other devices, batches are simply moved to the device.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                yield [x.to(self.device) for x in batch]
+            return
+        stream = torch.cuda.Stream(device=self.device)
+        loader_iter = iter(self.loader)
+        batch = self._preload(loader_iter, stream)
+        while batch is not None:
+            # wait for the copy and let the allocator know the tensors are used by the compute stream
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            for x in batch:
+                x.record_stream(current_stream)
+            next_batch = self._preload(loader_iter, stream)
+            yield batch
+            batch = next_batch
+
+    def _preload(self, loader_iter, stream):
+        """Starts the copy of the next batch on the side stream, returns None when the loader is exhausted"""
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            # only overlaps with compute if the loader uses pinned memory
+            return [x.to(self.device, non_blocking=True) for x in batch]
+
+
 def print_summary(acc_taw, acc_tag, forg_taw, forg_tag):
     """Print summary of results"""
     for name, metric in zip(['TAw Acc', 'TAg Acc', 'TAw Forg', 'TAg Forg'], [acc_taw, acc_tag, forg_taw, forg_tag]):